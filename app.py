@@ -1,13 +1,44 @@
+import gc
 import os
+import copy
+import hashlib
+import itertools
+import time
+import uuid
+import queue
+import asyncio
 import logging
+import threading
+from concurrent.futures import Future
+import aiofiles
+import aiofiles.os
+from cachetools import LRUCache, TTLCache
 from datetime import datetime, UTC
+
+# --- Thread Limits ---
+# Split the cores between server worker processes so concurrent requests don't oversubscribe
+# the CPU. WEB_CONCURRENCY is also what gunicorn reads for its worker count, so set the worker
+# count through it rather than --workers (see README). Set before torch/paddle load, since
+# OpenMP reads OMP_NUM_THREADS at import.
+N_WORKERS = max(1, int(os.environ.get('WEB_CONCURRENCY', '1')))
+INFERENCE_THREADS = max(1, (os.cpu_count() or 1) // N_WORKERS)
+os.environ.setdefault('OMP_NUM_THREADS', str(INFERENCE_THREADS))
+os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'max_split_size_mb:128')
+
+import torch
+import orjson
 from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from flask.json.provider import JSONProvider
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from PIL import Image
+import cv2
+import numpy as np
+import numba
 from paddleocr import PaddleOCR
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select
+from sqlalchemy.schema import CreateIndex, CreateTable
 from transformers import (
     AutoImageProcessor, AutoModelForImageClassification, 
     AutoTokenizer, AutoModelForCausalLM
@@ -20,8 +51,25 @@ from config import Config
 logging.basicConfig(level=logging.DEBUG)
 
 # --- App Setup ---
+class OrjsonProvider(JSONProvider):
+    """Serves jsonify() and request.json through orjson instead of the stdlib json module."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response, skipping the str round trip
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS), mimetype="application/json"
+        )
+
 app = Flask(__name__)
 app.config.from_object(Config)
+app.json = OrjsonProvider(app)
 
 # --- Database Setup ---
 db = SQLAlchemy(app)
@@ -41,7 +89,13 @@ try:
     logging.getLogger('ppocr').setLevel(logging.ERROR) 
     
     # Replaced 'use_angle_cls' and removed invalid 'show_log'
-    ocr_model = PaddleOCR(use_textline_orientation=True, lang='en')
+    # One text line per recognition batch keeps Paddle's memory arena small
+    ocr_model = PaddleOCR(
+        use_textline_orientation=True,
+        lang='en',
+        text_recognition_batch_size=1,
+        cpu_threads=INFERENCE_THREADS,
+    )
     logging.info("PaddleOCR initialized successfully.")
 except Exception as e:
     logging.error(f"PaddleOCR initialization FAILED: {repr(e)}")
@@ -53,11 +107,153 @@ FOOD_MODEL_LOCAL_FALLBACK = "nateraw/food"
 food_client = None 
 logging.info("Food recognition will use dual local models.")
 
-# Initialize OpenAI client for chat
+# Micro-batching: concurrent uploads share one forward pass
+MAX_BATCH = 8
+BATCH_WAIT_SECONDS = 0.02
+
+# --- Local Model Setup ---
+# Models are loaded once here and reused by every request.
+torch.set_grad_enabled(False)
+torch.set_num_threads(INFERENCE_THREADS)
+
+# Run on the GPU in FP16 when one is available, otherwise on the CPU (int8-quantized)
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+logging.info(f"Local models will run on: {DEVICE}")
+
+def _quantize(model):
+    """Applies dynamic int8 quantization to a model's nn.Linear layers (CPU only)."""
+    if not app.config['QUANTIZE_MODELS']:
+        return model
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def _prepare_torch_model(model):
+    """Puts a loaded PyTorch model in eval mode on DEVICE: FP16 on CUDA, int8-quantized on CPU."""
+    model.eval()
+    if DEVICE == "cuda":
+        return model.to(DEVICE, dtype=torch.float16)
+    return _quantize(model)
+
+def _food_input_size(processor):
+    """Returns the (width, height) a food model's processor resizes images to."""
+    size = processor.size
+    if "height" in size and "width" in size:
+        return size["width"], size["height"]
+    return size["shortest_edge"], size["shortest_edge"]
+
+def _compile_food_model(model, processor):
+    """
+    Wraps a PyTorch food model in torch.compile (inductor) when TORCH_COMPILE is on,
+    then runs a warmup forward so compilation happens at startup, not on the first
+    upload. Falls back to the eager model if compilation fails.
+    """
+    if not app.config['TORCH_COMPILE']:
+        return model
+    try:
+        mode = "reduce-overhead" if DEVICE == "cuda" else "default"
+        compiled = torch.compile(model, backend="inductor", mode=mode, dynamic=True)
+        width, height = _food_input_size(processor)
+        with torch.inference_mode():
+            compiled(pixel_values=torch.zeros(1, 3, height, width, device=DEVICE, dtype=model.dtype))
+        return compiled
+    except Exception as e:
+        logging.error(f"torch.compile FAILED, using eager model: {repr(e)}")
+        return model
+
+def _onnx_model_path(model_name):
+    """Returns the exported ONNX directory for a model, or None if there isn't one."""
+    if not app.config['ONNX_MODEL_DIR']:
+        return None
+    path = os.path.join(app.config['ONNX_MODEL_DIR'], model_name.replace('/', '__'))
+    return path if os.path.isdir(path) else None
+
+def _load_onnx_food_model(onnx_path):
+    """Loads an exported food classifier into ONNX Runtime (CUDA execution provider when installed)."""
+    import onnxruntime as ort
+    from optimum.onnxruntime import ORTModelForImageClassification
+
+    session_options = ort.SessionOptions()
+    session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session_options.intra_op_num_threads = INFERENCE_THREADS
+    # Ask onnxruntime itself: the CPU-only package has no CUDA provider even when torch sees a GPU
+    if DEVICE == "cuda" and "CUDAExecutionProvider" in ort.get_available_providers():
+        provider = "CUDAExecutionProvider"
+    else:
+        provider = "CPUExecutionProvider"
+    logging.debug(f"ONNX Runtime provider: {provider}")
+    return ORTModelForImageClassification.from_pretrained(
+        onnx_path,
+        session_options=session_options,
+        provider=provider,
+    )
+
+def _load_food_model(model_name):
+    """
+    Loads a local food recognition model and its processor.
+    Uses the ONNX Runtime export when one exists and loads, otherwise the PyTorch model.
+    Returns (processor, model) or (None, None) on failure.
+    """
+    try:
+        processor = AutoImageProcessor.from_pretrained(model_name, token=app.config['HF_TOKEN'])
+        onnx_path = _onnx_model_path(model_name)
+        if onnx_path:
+            try:
+                model = _load_onnx_food_model(onnx_path)
+                logging.info(f"Local food model loaded with ONNX Runtime: {model_name} ({onnx_path})")
+                return processor, model
+            except Exception as e:
+                # e.g. optimum not installed or a broken export
+                logging.error(f"ONNX Runtime load FAILED ({model_name}), falling back to PyTorch: {repr(e)}")
+
+        model = AutoModelForImageClassification.from_pretrained(model_name, token=app.config['HF_TOKEN'])
+        model = _compile_food_model(_prepare_torch_model(model), processor)
+        logging.info(f"Local food model loaded: {model_name}")
+        return processor, model
+    except Exception as e:
+        logging.error(f"Local food model initialization FAILED ({model_name}): {repr(e)}")
+        return None, None
+
+FOOD_MODELS = {
+    FOOD_MODEL_LOCAL_PRIMARY: _load_food_model(FOOD_MODEL_LOCAL_PRIMARY),
+    FOOD_MODEL_LOCAL_FALLBACK: _load_food_model(FOOD_MODEL_LOCAL_FALLBACK),
+}
+
+# Display labels per model, indexed by class id (e.g. "hot_dog" -> "Hot Dog")
+FOOD_LABELS = {
+    model_name: [model.config.id2label[i].replace('_', ' ').title() for i in range(len(model.config.id2label))]
+    for model_name, (_, model) in FOOD_MODELS.items()
+    if model
+}
+
+# Local DistilGPT-2 fallback for chat
+CHAT_FALLBACK_MODEL = "distilgpt2"
+CHAT_MAX_NEW_TOKENS = 64
+CHAT_MAX_PROMPT_TOKENS = 512
+# Static start of the local system prompt; its KV cache is computed once and reused
+CHAT_SYSTEM_PREFIX = "You are NutriBot, a helpful AI nutrition assistant."
+try:
+    CHAT_TOKENIZER = AutoTokenizer.from_pretrained(CHAT_FALLBACK_MODEL, token=app.config['HF_TOKEN'])
+    CHAT_MODEL_OBJ = AutoModelForCausalLM.from_pretrained(CHAT_FALLBACK_MODEL, token=app.config['HF_TOKEN'])
+    # DistilGPT-2 uses Conv1D blocks, so on CPU only its (largest) lm_head Linear is quantized
+    CHAT_MODEL_OBJ = _prepare_torch_model(CHAT_MODEL_OBJ)
+    CHAT_PREFIX_IDS = CHAT_TOKENIZER(CHAT_SYSTEM_PREFIX, return_tensors="pt")["input_ids"].to(DEVICE)
+    with torch.inference_mode():
+        CHAT_PREFIX_CACHE = CHAT_MODEL_OBJ(CHAT_PREFIX_IDS, use_cache=True).past_key_values
+    logging.info(f"Local chat model loaded: {CHAT_FALLBACK_MODEL}")
+except Exception as e:
+    logging.error(f"Local chat model initialization FAILED: {repr(e)}")
+    CHAT_TOKENIZER = None
+    CHAT_MODEL_OBJ = None
+    CHAT_PREFIX_IDS = None
+    CHAT_PREFIX_CACHE = None
+
+# OpenAI-compatible client settings for chat
 CHAT_MODEL = "meta-llama/Llama-3.1-8B-Instruct:novita"
+CHAT_API_BASE_URL = "https://router.huggingface.co/v1"
+# One sync client per process so its connection pool is reused across requests;
+# async views call it through asyncio.to_thread.
 try:
     chat_client = OpenAI(
-        base_url="https://router.huggingface.co/v1",
+        base_url=CHAT_API_BASE_URL,
         api_key=app.config['HF_TOKEN'],
     )
     logging.info("OpenAI client for chat initialized successfully.")
@@ -75,7 +271,7 @@ class User(UserMixin, db.Model):
     scans = db.relationship('Scan', backref='user', lazy=True)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, method=app.config['PASSWORD_HASH_METHOD'])
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
@@ -89,27 +285,183 @@ class Scan(db.Model):
     ocr_text = db.Column(db.Text, nullable=True) # Will store combined OCR or food list
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
+    # History and chat always read a user's most recent scans
+    __table_args__ = (db.Index('ix_scan_user_ts', 'user_id', 'timestamp'),)
+
+# Create tables at import so every entry point (gunicorn or `python app.py`) has a usable DB
+os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+with app.app_context():
+    # IF NOT EXISTS keeps this safe when several gunicorn workers start at once,
+    # and adds new indexes to databases created before they existed.
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            conn.execute(CreateTable(table, if_not_exists=True))
+            for index in table.indexes:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+
 # ==================================
 # --- AI HELPER FUNCTIONS ---
 # ==================================
 
-def extract_text(image_path):
-    """Uses PaddleOCR to read text from an image."""
+class MicroBatcher:
+    """
+    Collects inference requests from concurrent uploads and runs them as one batch.
+    `batch_fn` takes a list of inputs and returns a list of results in the same order.
+    A single worker thread flushes when `max_batch` items are queued or `max_wait`
+    seconds have passed since the first one arrived. If a batch fails, its items are
+    retried one at a time so only the input that actually breaks the model errors.
+    """
+
+    def __init__(self, name, batch_fn, max_batch=MAX_BATCH, max_wait=BATCH_WAIT_SECONDS):
+        self.batch_fn = batch_fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name=name, daemon=True)
+        self._worker.start()
+
+    async def submit(self, item):
+        """Queues one input and waits for its result (or re-raises the batch's error)."""
+        future = Future()
+        self._queue.put((item, future))
+        return await asyncio.wrap_future(future)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # Drop requests whose caller was cancelled; the rest are marked running, so a
+            # later cancel() is a no-op instead of racing with set_result()
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            try:
+                self._resolve(batch, results=self._call(batch))
+                continue
+            except Exception as e:
+                logging.error(f"Batch inference failed ({self._worker.name}, {len(batch)} input(s)): {repr(e)}")
+                if len(batch) == 1:
+                    self._resolve(batch, error=e)
+                    continue
+
+            for entry in batch:
+                try:
+                    self._resolve([entry], results=self._call([entry]))
+                except Exception as e:
+                    logging.error(f"Inference failed ({self._worker.name}): {repr(e)}")
+                    self._resolve([entry], error=e)
+
+    def _call(self, batch):
+        """Runs `batch_fn` on the batch's inputs and checks it returned one result per input."""
+        results = self.batch_fn([item for item, _ in batch])
+        if len(results) != len(batch):
+            raise RuntimeError(f"{self._worker.name} got {len(results)} results for {len(batch)} inputs")
+        return results
+
+    @staticmethod
+    def _resolve(batch, results=None, error=None):
+        """Hands each caller its result (or the batch error) without letting one bad future stop the worker."""
+        for i, (_, future) in enumerate(batch):
+            try:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(results[i])
+            except Exception as e:
+                logging.error(f"Could not resolve batched request: {repr(e)}")
+
+
+def _ocr_batch(images):
+    """Runs PaddleOCR once over a batch of BGR images. Returns one result per image."""
+    logging.debug(f"Running PaddleOCR on batch of {len(images)} image(s)")
+    return list(ocr_model.predict(images))
+
+
+# Serial on purpose: this runs inside request threads next to torch's own thread pool,
+# and a 224x224 image is too small for a second (numba) pool to pay off
+@numba.njit("float32[:, :, ::1](uint8[:, :, ::1], float32[::1], float32[::1])", fastmath=True, cache=True)
+def _normalize_hwc_to_chw(rgb, mean, std):
+    """Fused uint8 HWC -> normalized float32 CHW: ((pixel / 255) - mean) / std in one pass."""
+    height, width, channels = rgb.shape
+    scale = np.empty(channels, dtype=np.float32)
+    offset = np.empty(channels, dtype=np.float32)
+    for c in range(channels):
+        scale[c] = 1.0 / (255.0 * std[c])
+        offset[c] = mean[c] / std[c]
+
+    out = np.empty((channels, height, width), dtype=np.float32)
+    for y in range(height):
+        for x in range(width):
+            for c in range(channels):
+                out[c, y, x] = rgb[y, x, c] * scale[c] - offset[c]
+    return out
+
+
+def _preprocess_food_image(image_bgr, processor):
+    """
+    Resizes and normalizes a cv2 BGR image into the model's [C, H, W] float32 input.
+    Replaces the HF processor call: one cv2 resize on uint8, then a single numba pass.
+    """
+    width, height = _food_input_size(processor)
+    rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
+    rgb = cv2.resize(rgb, (width, height), interpolation=cv2.INTER_AREA)
+    mean = np.asarray(processor.image_mean, dtype=np.float32)
+    std = np.asarray(processor.image_std, dtype=np.float32)
+    return torch.from_numpy(_normalize_hwc_to_chw(rgb, mean, std))
+
+
+def _food_batch(model_name, pixel_values):
+    """Runs one local food model over a batch of preprocessed images. Returns top-5 labels per image."""
+    _, model = FOOD_MODELS[model_name]
+    logging.debug(f"Running {model_name} on batch of {len(pixel_values)} image(s)")
+    # ONNX exports take FP32 input; PyTorch models take their own dtype (FP16 on CUDA).
+    # Use the model's own device: an ONNX export can be on the CPU even on a GPU host.
+    dtype = model.dtype if isinstance(model, torch.nn.Module) else torch.float32
+    with torch.inference_mode():
+        outputs = model(pixel_values=torch.stack(pixel_values).to(model.device, dtype=dtype))
+
+    # Softmax doesn't change the ranking, so take top-5 straight from the logits.
+    # One tensor-to-list conversion for the whole batch, then plain list lookups.
+    top_5_indices = outputs.logits.topk(5, dim=-1).indices.tolist()
+    labels = FOOD_LABELS[model_name]
+    return [[labels[i] for i in row] for row in top_5_indices]
+
+
+OCR_BATCHER = MicroBatcher("ocr-batcher", _ocr_batch) if ocr_model else None
+FOOD_BATCHERS = {
+    model_name: MicroBatcher(f"food-batcher-{model_name}", lambda pixel_values, name=model_name: _food_batch(name, pixel_values))
+    for model_name, (_, model) in FOOD_MODELS.items()
+    if model
+}
+
+
+async def extract_text(image_bgr):
+    """Uses PaddleOCR to read text from a decoded (cv2 BGR) image."""
     if not ocr_model:
         logging.error("PaddleOCR model is not available.")
         return "Error: OCR model is not initialized."
     try:
-        logging.debug(f"Processing image with PaddleOCR: {image_path}")
+        logging.debug(f"Processing image with PaddleOCR: {image_bgr.shape}")
         
-        # *** FIX: Changed from .ocr(cls=True) to .predict() ***
-        result = ocr_model.predict(image_path)
+        # Batched with any other uploads arriving at the same time
+        result = await OCR_BATCHER.submit(image_bgr)
         
-        if not result or not result[0]:
+        if not result:
             logging.warning("PaddleOCR returned no text.")
             return "OCR returned no text. Image may be unclear."
 
         lines = []
-        for res_line in result[0]:
+        for res_line in result:
             # res_line format is [[box], (text, confidence)]
             text = res_line[1][0]
             lines.append(text)
@@ -123,26 +475,19 @@ def extract_text(image_path):
         return f"Error: PaddleOCR failed. (Reason: {repr(e)})"
 
 
-def _recognize_food_local(image_path, model_name):
+async def _recognize_food_local(image_bgr, model_name):
     """
-    Helper function to run a local food recognition model.
+    Helper function to run a local food recognition model on a cv2 BGR image.
     Returns (list_of_labels, None) or (None, error_string)
     """
+    if model_name not in FOOD_BATCHERS:
+        logging.error(f"Local food model is not available: {model_name}")
+        return None, f"Error: Food model {model_name} is not initialized."
     try:
-        logging.debug(f"Loading local food model: {model_name}")
-        
-        processor = AutoImageProcessor.from_pretrained(model_name, token=app.config['HF_TOKEN'])
-        model = AutoModelForImageClassification.from_pretrained(model_name, token=app.config['HF_TOKEN'])
-        
-        image = Image.open(image_path).convert("RGB")
-        inputs = processor(image, return_tensors="pt")
-        outputs = model(**inputs)
-        logits = outputs.logits
-        probs = logits.softmax(dim=-1)
-        
-        top_5_indices = probs[0].topk(5).indices
-        top_5_labels = [model.config.id2label[i.item()].replace('_', ' ').title() for i in top_5_indices]
-        
+        # Preprocess here so a bad upload fails on its own instead of failing the whole batch
+        processor, _ = FOOD_MODELS[model_name]
+        pixel_values = _preprocess_food_image(image_bgr, processor)
+        top_5_labels = await FOOD_BATCHERS[model_name].submit(pixel_values)
         logging.debug(f"Local food recognition successful ({model_name}): {top_5_labels}")
         return top_5_labels, None # Return list of labels, no error
     except Exception as e:
@@ -150,23 +495,19 @@ def _recognize_food_local(image_path, model_name):
         return None, f"Error: Could not identify food (Local). (Reason: {repr(e)})"
 
 
-def recognize_food(image_path):
+async def recognize_food(image_bgr):
     """
     Uses two local food models to find the "best pick" identification.
+    Takes a decoded (cv2 BGR) image; both models resize from the same array.
     Returns a clean text string (e.g., "Hamburger") and an error string (if any).
     """
-    logging.debug(f"Starting dual food recognition for: {image_path}")
+    logging.debug(f"Starting dual food recognition for image: {image_bgr.shape}")
 
-    # 1. Run primary local model (prithivMLmods)
-    labels_1, err_1 = _recognize_food_local(
-        image_path, 
-        FOOD_MODEL_LOCAL_PRIMARY 
-    )
-    
-    # 2. Run secondary local model (nateraw)
-    labels_2, err_2 = _recognize_food_local(
-        image_path, 
-        FOOD_MODEL_LOCAL_FALLBACK
+    # 1. Run primary local model (prithivMLmods) and 2. secondary local model (nateraw).
+    # Each has its own batcher thread, so the two forward passes overlap.
+    (labels_1, err_1), (labels_2, err_2) = await asyncio.gather(
+        _recognize_food_local(image_bgr, FOOD_MODEL_LOCAL_PRIMARY),
+        _recognize_food_local(image_bgr, FOOD_MODEL_LOCAL_FALLBACK),
     )
 
     # 3. Check for total failure
@@ -201,6 +542,34 @@ def recognize_food(image_path):
     logging.debug(f"Best pick for food: {best_pick_text}")
     return best_pick_text, None # Return clean string, no error
 
+def decode_image(buf):
+    """Decodes uploaded image bytes into a cv2 BGR array, or None if they aren't an image."""
+    return cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_COLOR)
+
+
+async def save_upload(buf, filepath):
+    """Writes an analyzed upload to disk without blocking the event loop. Raises on failure."""
+    try:
+        await aiofiles.os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        async with aiofiles.open(filepath, 'wb') as f:
+            await f.write(buf)
+        logging.debug(f"File saved: {filepath}")
+    except Exception as e:
+        logging.error(f"Failed to save file: {repr(e)}")
+        raise
+
+
+async def remove_upload(filepath):
+    """Deletes an upload whose analysis failed (no-op if it was never written)."""
+    try:
+        await aiofiles.os.remove(filepath)
+        logging.debug(f"File removed: {filepath}")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.error(f"Failed to remove file: {repr(e)}")
+
+
 def get_ai_nutrition_analysis(context_text, system_prompt, user_prompt):
     """
     Calls the chat API to get a nutritional analysis.
@@ -237,33 +606,186 @@ def get_ai_nutrition_analysis(context_text, system_prompt, user_prompt):
         logging.error(f"Chat API analysis Error: {repr(e)}")
         return None, f"Error during AI analysis: {repr(e)}"
 
+# Analysis results by (scan_type, sha256 of the upload), so re-submitting the same photo skips the models
+ANALYSIS_CACHE = LRUCache(maxsize=512)
+_analysis_cache_lock = threading.Lock()
+
+async def analyze_scan(buf, scan_type):
+    """
+    Runs OCR or food recognition plus the AI verdict and long-term report for an upload.
+    Returns ((ocr_text, quick_verdict, detailed_report), None) or (None, (error_message, status_code)).
+    """
+    cache_key = (scan_type, hashlib.sha256(buf).hexdigest())
+    with _analysis_cache_lock:
+        cached = ANALYSIS_CACHE.get(cache_key)
+    if cached is not None:
+        logging.debug(f"Analysis cache hit for {scan_type} upload {cache_key[1][:12]}")
+        return cached, None
+
+    image_bgr = decode_image(buf)
+    if image_bgr is None:
+        logging.error("Could not decode uploaded image")
+        return None, ("Could not read the uploaded image.", 400)
+
+    ocr_text_to_save = ""
+    quick_verdict = ""
+    detailed_report = []
+    report_err = None
+
+    if scan_type == 'label':
+        # 1. Get OCR text from PaddleOCR
+        logging.debug("Scan type 'label': Starting PaddleOCR.")
+        ocr_text_to_save = await extract_text(image_bgr) # This now uses Paddle
+        if "Error:" in ocr_text_to_save:
+            logging.error(f"PaddleOCR failed: {ocr_text_to_save}")
+            return None, (ocr_text_to_save, 400)
+
+        # 2. Get AI Quick Verdict and 3. AI Detailed Report (Long-Term), concurrently
+        verdict_sys_prompt = "You are a professional nutritionist. You have read the following nutrition label text."
+        verdict_user_prompt = "Provide a concise, one-paragraph verdict on this product's healthiness based on the text. Speak as the nutritionist."
+        report_sys_prompt = "You are a professional nutritionist."
+        report_user_prompt = "Based on the nutrition label text, what are the potential long-term health impacts (positive or negative) of consuming this item regularly? Be concise and use bullet points."
+        (verdict, err), (report, report_err) = await asyncio.gather(
+            asyncio.to_thread(get_ai_nutrition_analysis, ocr_text_to_save, verdict_sys_prompt, verdict_user_prompt),
+            asyncio.to_thread(get_ai_nutrition_analysis, ocr_text_to_save, report_sys_prompt, report_user_prompt),
+        )
+        if err:
+            logging.error(f"AI Verdict failed: {err}")
+            return None, (f"AI analysis failed: {err}", 500)
+        quick_verdict = verdict
+
+        if report_err:
+            logging.error(f"AI Report failed: {report_err}")
+            detailed_report = [{"nutrient": "Long-Term Impact", "impact": f"Failed to generate report: {report_err}"}]
+        else:
+            detailed_report = [{"nutrient": "Long-Term Impact", "impact": report}]
+        
+        logging.debug(f"Label analysis complete. Verdict: {quick_verdict[:50]}...")
+        
+    elif scan_type == 'food':
+        # 1. Get "best pick" food recognition text
+        logging.debug("Scan type 'food': Starting dual food recognition.")
+        best_pick_text, err = await recognize_food(image_bgr) 
+        
+        if err:
+            logging.error(f"Food recognition failed: {err}")
+            return None, (err, 400)
+        
+        ocr_text_to_save = best_pick_text # This is the clean string, e.g., "Hamburger"
+
+        # 2. Get AI Quick Verdict and 3. AI Detailed Report (Long-Term), concurrently
+        verdict_sys_prompt = "You are a professional nutritionist. A food item has been identified."
+        verdict_user_prompt = f"The food is: {ocr_text_to_save}. Provide a concise, one-paragraph nutritional verdict on this item. Speak as the nutritionist."
+        report_sys_prompt = "You are a professional nutritionist."
+        report_user_prompt = f"The food is: {ocr_text_to_save}. What are the potential long-term health impacts (positive or negative) of consuming this item regularly? Be concise and use bullet points."
+        (verdict, err), (report, report_err) = await asyncio.gather(
+            asyncio.to_thread(get_ai_nutrition_analysis, ocr_text_to_save, verdict_sys_prompt, verdict_user_prompt),
+            asyncio.to_thread(get_ai_nutrition_analysis, ocr_text_to_save, report_sys_prompt, report_user_prompt),
+        )
+        if err:
+            logging.error(f"AI Verdict failed: {err}")
+            return None, (f"AI analysis failed: {err}", 500)
+        quick_verdict = verdict
+        
+        if report_err:
+            logging.error(f"AI Report failed: {report_err}")
+            detailed_report = [{"nutrient": "Long-Term Impact", "impact": f"Failed to generate report: {report_err}"}]
+        else:
+            detailed_report = [{"nutrient": "Long-Term Impact", "impact": report}]
+            
+        logging.debug(f"Food analysis complete. Verdict: {quick_verdict[:50]}...")
+
+    result = (ocr_text_to_save, quick_verdict, detailed_report)
+    # A failed report is worth retrying, so only cache complete analyses
+    if not report_err:
+        with _analysis_cache_lock:
+            ANALYSIS_CACHE[cache_key] = result
+    return result, None
+
+# Joined recent verdicts for the chat system prompt, by user id. Entries expire after a minute;
+# /analyze invalidates them in its own process, so other gunicorn workers lag by at most the TTL.
+RECENT_VERDICTS_CACHE = TTLCache(maxsize=1024, ttl=60)
+_recent_verdicts_lock = threading.Lock()
+
+def get_recent_verdicts(user_id):
+    """Returns the user's 10 most recent scan verdicts as one comma-separated string."""
+    with _recent_verdicts_lock:
+        cached = RECENT_VERDICTS_CACHE.get(user_id)
+    if cached is not None:
+        return cached
+
+    verdicts = db.session.scalars(
+        select(Scan.quick_verdict).where(Scan.user_id == user_id).order_by(Scan.timestamp.desc()).limit(10)
+    ).all()
+    joined = ', '.join(verdicts)
+    with _recent_verdicts_lock:
+        RECENT_VERDICTS_CACHE[user_id] = joined
+    return joined
+
+def invalidate_recent_verdicts(user_id):
+    """Drops the cached verdicts after the user saves a new scan."""
+    with _recent_verdicts_lock:
+        RECENT_VERDICTS_CACHE.pop(user_id, None)
+
 def chat_with_bot_local(message):
     """Uses local DistilGPT-2 model for chatbot conversation."""
-    CHAT_FALLBACK_MODEL = "distilgpt2"
+    if not CHAT_MODEL_OBJ:
+        logging.error("Local chat model is not available.")
+        return "Error: Local chat model is not initialized."
     try:
-        logging.debug(f"Loading local chat model: {CHAT_FALLBACK_MODEL}")
-        chat_tokenizer = AutoTokenizer.from_pretrained(CHAT_FALLBACK_MODEL, token=app.config['HF_TOKEN'])
-        chat_model = AutoModelForCausalLM.from_pretrained(CHAT_FALLBACK_MODEL, token=app.config['HF_TOKEN'])
-        user_scans = Scan.query.filter_by(user_id=current_user.id).order_by(Scan.timestamp.desc()).limit(10).all()
-        eaten_foods = [scan.quick_verdict for scan in user_scans]
-        system_prompt = f"You are NutriBot, a helpful AI nutrition assistant. The user's recent scans: {', '.join(eaten_foods)}. Be concise and helpful."
-        prompt = f"{system_prompt}\n\nUser: {message}"
-        logging.debug(f"Chat prompt: {prompt}")
-        inputs = chat_tokenizer(prompt, return_tensors="pt", truncation=True, max_length=512)
-        outputs = chat_model.generate(
-            inputs["input_ids"],
-            max_new_tokens=250,
-            temperature=0.7,
-            pad_token_id=chat_tokenizer.eos_token_id
-        )
-        response = chat_tokenizer.decode(outputs[0], skip_special_tokens=True)
-        response = response[len(prompt):].strip()
+        eaten_foods = get_recent_verdicts(current_user.id)
+        prompt_suffix = f" The user's recent scans: {eaten_foods}. Be concise and helpful.\n\nUser: {message}"
+        logging.debug(f"Chat prompt: {CHAT_SYSTEM_PREFIX}{prompt_suffix}")
+
+        # Only the per-request suffix is new; the prefix is served from CHAT_PREFIX_CACHE
+        suffix_ids = CHAT_TOKENIZER(
+            prompt_suffix, return_tensors="pt", truncation=True,
+            max_length=CHAT_MAX_PROMPT_TOKENS - CHAT_PREFIX_IDS.shape[-1]
+        )["input_ids"].to(DEVICE)
+        input_ids = torch.cat([CHAT_PREFIX_IDS, suffix_ids], dim=-1)
+        with torch.inference_mode():
+            outputs = CHAT_MODEL_OBJ.generate(
+                input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=copy.deepcopy(CHAT_PREFIX_CACHE), # generate() extends the cache in place
+                use_cache=True,
+                num_beams=1,
+                do_sample=False,
+                max_new_tokens=CHAT_MAX_NEW_TOKENS,
+                pad_token_id=CHAT_TOKENIZER.eos_token_id
+            )
+        response = CHAT_TOKENIZER.decode(outputs[0][input_ids.shape[-1]:], skip_special_tokens=True).strip()
         logging.debug(f"Chat response: {response}")
         return response
     except Exception as e:
         logging.error(f"Local Chat Model Error: {repr(e)}")
         return f"Error: Chatbot failed. (Reason: {repr(e)})"
 
+def _max_upload_size_label():
+    """MAX_UPLOAD_SIZE as a human-readable size for error messages, e.g. '10MB'."""
+    return f"{app.config['MAX_UPLOAD_SIZE'] // (1024 * 1024)}MB"
+
+@app.errorhandler(413)
+def request_too_large(e):
+    """Werkzeug enforces MAX_CONTENT_LENGTH on any route while reading the request body."""
+    logging.error(f"Request body too large on {request.path}: {repr(e)}")
+    return jsonify({'error': f'Request too large (Max {_max_upload_size_label()}).'}), 413
+
+# ==================================
+# --- MEMORY HOUSEKEEPING ---
+# ==================================
+_request_counter = itertools.count(1)
+
+@app.after_request
+def collect_garbage_periodically(response):
+    """Every GC_EVERY_N_REQUESTS requests, run gc and release cached CUDA blocks to curb RSS growth."""
+    if next(_request_counter) % app.config['GC_EVERY_N_REQUESTS'] == 0:
+        gc.collect()
+        if DEVICE == "cuda":
+            torch.cuda.empty_cache()
+        logging.debug("Periodic garbage collection done.")
+    return response
+
 # ==================================
 # --- AUTHENTICATION ROUTES ---
 # ==================================
@@ -272,12 +794,13 @@ def load_user(user_id):
     return db.session.get(User, int(user_id))
 
 @app.route('/login', methods=['GET', 'POST'])
-def login():
+async def login():
     if current_user.is_authenticated:
         return redirect(url_for('home'))
     if request.method == 'POST':
-        user = User.query.filter_by(username=request.form['username']).first()
-        if user and user.check_password(request.form['password']):
+        user = db.session.scalar(select(User).where(User.username == request.form['username']))
+        # Hashing is CPU-bound, so keep it off the event loop
+        if user and await asyncio.to_thread(user.check_password, request.form['password']):
             login_user(user)
             return redirect(url_for('home'))
         else:
@@ -285,15 +808,15 @@ def login():
     return render_template('login.html')
 
 @app.route('/register', methods=['GET', 'POST'])
-def register():
+async def register():
     if current_user.is_authenticated:
         return redirect(url_for('home'))
     if request.method == 'POST':
-        if User.query.filter_by(username=request.form['username']).first():
+        if db.session.scalar(select(User).where(User.username == request.form['username'])):
             flash("Username already exists.")
         else:
             new_user = User(username=request.form['username'])
-            new_user.set_password(request.form['password'])
+            await asyncio.to_thread(new_user.set_password, request.form['password'])
             db.session.add(new_user)
             db.session.commit()
             login_user(new_user)
@@ -316,10 +839,12 @@ def home():
 
 @app.route('/history', methods=['GET'])
 @login_required
-def get_history():
+async def get_history():
     """Fetches personalized history from the database."""
     try:
-        user_scans = Scan.query.filter_by(user_id=current_user.id).order_by(Scan.timestamp.desc()).limit(30).all()
+        user_scans = db.session.scalars(
+            select(Scan).where(Scan.user_id == current_user.id).order_by(Scan.timestamp.desc()).limit(30)
+        ).all()
         history_list = [{
             "filename": scan.filename,
             "timestamp": scan.timestamp.strftime("%Y-%m-%d %H:%M"),
@@ -334,8 +859,13 @@ def get_history():
 
 @app.route('/analyze', methods=['POST'])
 @login_required
-def analyze_image():
+async def analyze_image():
     """Analyzes an image (OCR or Food) and saves to DB."""
+    # Reject oversized uploads from the header, before the body is parsed or spooled
+    if request.content_length and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        logging.error(f"File too large: {request.content_length} bytes")
+        return jsonify({'error': f'File too large (Max {_max_upload_size_label()}). Got: {request.content_length} bytes'}), 413
+
     logging.debug(f"Received /analyze request: {request.form}, files: {request.files}")
     
     if 'file' not in request.files:
@@ -354,97 +884,43 @@ def analyze_image():
         logging.error(f"Invalid file type: {file.filename}")
         return jsonify({'error': f"Invalid file type. Please upload a (png, jpg, jpeg, webp) file. Got: {file.filename}"}), 400
     
-    file.seek(0, 2)
-    file_size = file.tell()
-    file.seek(0)
-    if file_size > 10 * 1024 * 1024:  # 10MB
-        logging.error(f"File too large: {file_size} bytes")
-        return jsonify({'error': f'File too large (Max 10MB). Got: {file_size} bytes'}), 400
-    
     if scan_type not in ['label', 'food']:
         logging.error(f"Invalid scan_type: {scan_type}")
         return jsonify({'error': f"Invalid scan_type. Must be 'label' or 'food'. Got: {scan_type}"}), 400
 
     original_filename = secure_filename(file.filename)
     timestamp_str = datetime.now(UTC).strftime("%Y%m%d_%H%M%S")
-    filename = f"{current_user.id}_{timestamp_str}_{original_filename}"
+    # The random part keeps same-second uploads of the same name apart, so cleaning up
+    # after a failed request can never delete another request's file
+    filename = f"{current_user.id}_{timestamp_str}_{uuid.uuid4().hex[:12]}_{original_filename}"
     filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
     
-    try:
-        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-        file.save(filepath)
-        logging.debug(f"File saved: {filepath}")
-    except Exception as e:
-        logging.error(f"Failed to save file: {repr(e)}")
-        return jsonify({'error': f'Failed to save file: {repr(e)}'}), 500
-
-    ocr_text_to_save = ""
-    quick_verdict = ""
-    detailed_report = []
+    buf = file.read()
+    if len(buf) > app.config['MAX_UPLOAD_SIZE']:
+        logging.error(f"File too large: {len(buf)} bytes")
+        return jsonify({'error': f'File too large (Max {_max_upload_size_label()}). Got: {len(buf)} bytes'}), 400
 
+    # Analyze straight from memory while the upload is written to disk in parallel
     try:
-        if scan_type == 'label':
-            # 1. Get OCR text from PaddleOCR
-            logging.debug("Scan type 'label': Starting PaddleOCR.")
-            ocr_text_to_save = extract_text(filepath) # This now uses Paddle
-            if "Error:" in ocr_text_to_save:
-                logging.error(f"PaddleOCR failed: {ocr_text_to_save}")
-                return jsonify({'error': ocr_text_to_save}), 400
-
-            # 2. Get AI Quick Verdict
-            verdict_sys_prompt = "You are a professional nutritionist. You have read the following nutrition label text."
-            verdict_user_prompt = "Provide a concise, one-paragraph verdict on this product's healthiness based on the text. Speak as the nutritionist."
-            verdict, err = get_ai_nutrition_analysis(ocr_text_to_save, verdict_sys_prompt, verdict_user_prompt)
-            if err:
-                logging.error(f"AI Verdict failed: {err}")
-                return jsonify({'error': f"AI analysis failed: {err}"}), 500
-            quick_verdict = verdict
-
-            # 3. Get AI Detailed Report (Long-Term)
-            report_sys_prompt = "You are a professional nutritionist."
-            report_user_prompt = "Based on the nutrition label text, what are the potential long-term health impacts (positive or negative) of consuming this item regularly? Be concise and use bullet points."
-            report, err = get_ai_nutrition_analysis(ocr_text_to_save, report_sys_prompt, report_user_prompt)
-            if err:
-                logging.error(f"AI Report failed: {err}")
-                detailed_report = [{"nutrient": "Long-Term Impact", "impact": f"Failed to generate report: {err}"}]
-            else:
-                detailed_report = [{"nutrient": "Long-Term Impact", "impact": report}]
-            
-            logging.debug(f"Label analysis complete. Verdict: {quick_verdict[:50]}...")
-            
-        elif scan_type == 'food':
-            # 1. Get "best pick" food recognition text
-            logging.debug("Scan type 'food': Starting dual food recognition.")
-            best_pick_text, err = recognize_food(filepath) 
-            
-            if err:
-                logging.error(f"Food recognition failed: {err}")
-                return jsonify({'error': err}), 400
-            
-            ocr_text_to_save = best_pick_text # This is the clean string, e.g., "Hamburger"
-
-            # 2. Get AI Quick Verdict
-            verdict_sys_prompt = "You are a professional nutritionist. A food item has been identified."
-            verdict_user_prompt = f"The food is: {ocr_text_to_save}. Provide a concise, one-paragraph nutritional verdict on this item. Speak as the nutritionist."
-            verdict, err = get_ai_nutrition_analysis(ocr_text_to_save, verdict_sys_prompt, verdict_user_prompt)
-            if err:
-                logging.error(f"AI Verdict failed: {err}")
-                return jsonify({'error': f"AI analysis failed: {err}"}), 500
-            quick_verdict = verdict
-            
-            # 3. Get AI Detailed Report (Long-Term)
-            report_sys_prompt = "You are a professional nutritionist."
-            report_user_prompt = f"The food is: {ocr_text_to_save}. What are the potential long-term health impacts (positive or negative) of consuming this item regularly? Be concise and use bullet points."
-            report, err = get_ai_nutrition_analysis(ocr_text_to_save, report_sys_prompt, report_user_prompt)
-            if err:
-                logging.error(f"AI Report failed: {err}")
-                detailed_report = [{"nutrient": "Long-Term Impact", "impact": f"Failed to generate report: {err}"}]
-            else:
-                detailed_report = [{"nutrient": "Long-Term Impact", "impact": report}]
-                
-            logging.debug(f"Food analysis complete. Verdict: {quick_verdict[:50]}...")
-
-        # --- Save to DB and return (This part is the same as before) ---
+        # return_exceptions lets both finish, so a failed save is seen before anything is committed
+        analysis, save_error = await asyncio.gather(
+            analyze_scan(buf, scan_type),
+            save_upload(buf, filepath),
+            return_exceptions=True,
+        )
+        if isinstance(analysis, BaseException):
+            raise analysis
+        result, error = analysis
+        if error:
+            await remove_upload(filepath)
+            message, status_code = error
+            return jsonify({'error': message}), status_code
+        if isinstance(save_error, BaseException):
+            await remove_upload(filepath)
+            return jsonify({'error': f'Failed to save file: {repr(save_error)}'}), 500
+        ocr_text_to_save, quick_verdict, detailed_report = result
+
+        # --- Save to DB and return ---
         new_scan = Scan(
             filename=filename,
             scan_type=scan_type,
@@ -454,6 +930,7 @@ def analyze_image():
         )
         db.session.add(new_scan)
         db.session.commit()
+        invalidate_recent_verdicts(current_user.id)
         logging.debug(f"Scan saved to DB: {filename}, type: {scan_type}")
 
         return jsonify({
@@ -466,11 +943,12 @@ def analyze_image():
         })
     except Exception as e:
         logging.error(f"Analyze Error: {repr(e)}")
+        await remove_upload(filepath)
         return jsonify({'error': f'An unexpected error occurred: {repr(e)}'}), 500
 
 @app.route('/chat', methods=['POST'])
 @login_required
-def chat_with_bot():
+async def chat_with_bot():
     """Handles chatbot conversation using HF Inference API with local fallback."""
     logging.debug(f"Received /chat request: {request.json}")
     
@@ -484,28 +962,27 @@ def chat_with_bot():
         return jsonify({'error': 'Message cannot be empty'}), 400
     
     try:
-        user_scans = Scan.query.filter_by(user_id=current_user.id).order_by(Scan.timestamp.desc()).limit(10).all()
-        eaten_foods = [scan.quick_verdict for scan in user_scans] 
-        system_prompt = f"You are NutriBot, a helpful AI nutrition assistant. The user's recent scan history (verdicts): {', '.join(eaten_foods)}. Be concise and helpful."
+        eaten_foods = get_recent_verdicts(current_user.id)
+        system_prompt = f"You are NutriBot, a helpful AI nutrition assistant. The user's recent scan history (verdicts): {eaten_foods}. Be concise and helpful."
         
         # Try OpenAI-compatible Inference API
-        if chat_client:
-            try:
-                logging.debug(f"Trying Inference API with chat model: {CHAT_MODEL}")
-                completion = chat_client.chat.completions.create(
-                    model=CHAT_MODEL,
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_message}
-                    ],
-                    max_tokens=250,
-                    temperature=0.7,
-                )
-                response = completion.choices[0].message.content
-                logging.debug(f"Chat API response: {response}")
-                return jsonify({'reply': response})
-            except Exception as e:
-                logging.error(f"HF Chat API Error: {repr(e)}")
+        try:
+            logging.debug(f"Trying Inference API with chat model: {CHAT_MODEL}")
+            completion = await asyncio.to_thread(
+                chat_client.chat.completions.create,
+                model=CHAT_MODEL,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_message}
+                ],
+                max_tokens=CHAT_MAX_NEW_TOKENS,
+                temperature=0.7,
+            )
+            response = completion.choices[0].message.content
+            logging.debug(f"Chat API response: {response}")
+            return jsonify({'reply': response})
+        except Exception as e:
+            logging.error(f"HF Chat API Error: {repr(e)}")
         
         # Fallback to local DistilGPT-2
         response = chat_with_bot_local(user_message)
@@ -521,9 +998,7 @@ def chat_with_bot():
 # ==================================
 # --- APP INITIALIZATION ---
 # ==================================
+# Production: `WEB_CONCURRENCY=N gunicorn --threads 8 --bind 0.0.0.0:8080 app:app` (see README)
 if __name__ == '__main__':
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-    with app.app_context():
-        db.create_all()
     # Run Flask on all network interfaces, port 8080 (changeable)
     app.run(host='0.0.0.0', port=8080, debug=True)
@@ -30,5 +30,28 @@ class Config:
     # It will now be 'None' if the key is not in the .env file
     HF_TOKEN = os.environ.get('HF_TOKEN') 
     
+    # Password hashing (Werkzeug method string). scrypt with N=2**14 costs ~16 MiB and a
+    # fraction of Werkzeug's default (N=2**15) CPU time per login. Existing hashes keep
+    # verifying because each hash records its own method.
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:16384:8:1')
+
+    # Local models: dynamic int8 quantization of Linear layers (set to 0 to keep FP32)
+    QUANTIZE_MODELS = os.environ.get('QUANTIZE_MODELS', '1') == '1'
+
+    # Local models: torch.compile the PyTorch food classifiers at startup (slower boot, faster requests)
+    TORCH_COMPILE = os.environ.get('TORCH_COMPILE', '0') == '1'
+
+    # Local models: directory of ONNX exports, one subfolder per model with '/' replaced by '__'
+    # e.g. onnx_models/nateraw__food (see README). Unset to use the PyTorch models.
+    ONNX_MODEL_DIR = os.environ.get('ONNX_MODEL_DIR')
+
+    # Local models: run gc.collect() (and empty the CUDA cache) every N requests
+    GC_EVERY_N_REQUESTS = int(os.environ.get('GC_EVERY_N_REQUESTS', '100'))
+
     # App-specific
-    UPLOAD_FOLDER = 'static/uploads'
\ No newline at end of file
+    UPLOAD_FOLDER = 'static/uploads'
+    # Largest accepted image (10MB)
+    MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+    # Werkzeug rejects request bodies above this size before spooling them;
+    # the extra 64KB leaves room for multipart framing around a full-size image
+    MAX_CONTENT_LENGTH = MAX_UPLOAD_SIZE + 64 * 1024